@@ -0,0 +1 @@
+../nano_loadtest.py
\ No newline at end of file
@@ -0,0 +1 @@
+../nano_sse.py
\ No newline at end of file
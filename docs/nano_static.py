@@ -0,0 +1 @@
+../nano_static.py
\ No newline at end of file
@@ -7,6 +7,7 @@ Nano -- Web Framework in about 100 LOC
 import os
 import sys
 import re
+import functools
 import traceback
 import mimetypes
 import urllib
@@ -68,6 +69,40 @@ class HttpError(Exception):
             return True, traceback.format_exception(*self.get_exc_info())
         return False, ''
 
+class _ClosingIterator(object):
+    # Wraps a response body iterator, calling `callback(exc)` once the server
+    # closes it, with `exc` being the exception raised during iteration.
+    def __init__(self, body, callback):
+        self.body = body
+        self.iterator = iter(body)
+        self.callback = callback
+        self.exc = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.iterator.next()
+        except StopIteration:
+            raise
+        except Exception, exc:
+            self.exc = exc
+            raise
+
+    def close(self):
+        callback, self.callback = self.callback, None
+        if callback is None:
+            return
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            callback(self.exc)
+
+def not_found(environ):
+    raise HttpError(404)
+
 class NanoApplication(object):
     """
     Central Nano object that functions as WSGI application passed to the WSGI
@@ -93,16 +128,28 @@ class NanoApplication(object):
             read and sent per iteration.
         `default_content_type`
             Sets what should be used as default `Content-Type` HTTP header
+
+    Request hooks may be registered for all routes using
+    :meth:`before_request`, :meth:`after_request` and :meth:`teardown_request`
+    or for single routes using :meth:`route`. Hooks are assembled into one
+    handler per route when the first request is made (or :meth:`freeze` is
+    called); routes without any hooks call the view function directly.
     """
     def __init__(self, debug=False, charset='utf-8', chunksize=8*1024,
                        default_content_type='text/plain'):
         self.routes = []
+        self.route_hooks = {}
+        self.before_hooks = []
+        self.after_hooks = []
+        self.teardown_hooks = []
+        self.handlers = None
+        self.not_found_handler = None
         self.debug = debug
         self.charset = charset
         self.chunksize = chunksize
         self.default_content_type = default_content_type
 
-    def route(self, pattern):
+    def route(self, pattern, before=(), after=(), teardown=()):
         """
         Decorator to map a URL pattern to a view function.
 
@@ -120,14 +167,159 @@ class NanoApplication(object):
             @app.route('/post/:slug:/')
             def view_page(environ, slug):
                 return get_post_by_slug(slug)
+
+        `before`, `after` and `teardown` are sequences of hooks that should be
+        run for this route only, in addition to the global hooks; see
+        :meth:`before_request`, :meth:`after_request` and
+        :meth:`teardown_request` for their signatures.
         """
         pattern = re.sub(':([a-z0-9_]+):', '(?P<\g<1>>[^/]+)', pattern)
         pattern = re.compile('^%s$' % pattern)
         def decorator(callback):
             self.routes.append((pattern, callback))
+            if before or after or teardown:
+                self.route_hooks[pattern, callback] = \
+                    (tuple(before), tuple(after), tuple(teardown))
+            self.handlers = None
             return callback
         return decorator
 
+    def before_request(self, hook):
+        """
+        Decorator to register a function ``hook(environ)`` that is called
+        before any view function. If it returns anything but `None`, the
+        view function is skipped and the return value is used as response.
+        Global hooks are run before route-specific ones; they are also run
+        for URLs no route matches, before the `404` response is made.
+        """
+        self.before_hooks.append(hook)
+        self.handlers = None
+        return hook
+
+    def after_request(self, hook):
+        """
+        Decorator to register a function
+        ``hook(environ, status, headers, body)`` that is called with the
+        response returned from a view function (or a before hook) and must
+        return a new ``(status, headers, body)`` triple. `headers` is a
+        dictionary that may be modified in place. `body` is passed as
+        returned from the view, so iterators can be wrapped without reading
+        them. Route-specific hooks are run before global ones.
+
+        Global hooks also get error responses, i.e. those made for
+        :class:`HttpError`\ s and other exceptions raised by views or hooks
+        and the `404` response for URLs no route matches. Route-specific
+        hooks only get responses returned normally.
+
+        ::
+
+            @app.after_request
+            def add_server_header(environ, status, headers, body):
+                headers['Server'] = 'Nano'
+                return status, headers, body
+        """
+        self.after_hooks.append(hook)
+        self.handlers = None
+        return hook
+
+    def teardown_request(self, hook):
+        """
+        Decorator to register a function ``hook(environ, exc)`` that is called
+        once the response is complete, even if an exception was raised, which
+        is then passed as `exc` (`None` otherwise). For responses with an
+        iterator body, that is when the server closes the iterator, i.e.
+        after the body has been sent. Exceptions raised by teardown hooks
+        are printed and otherwise ignored. Route-specific hooks are run
+        before global ones.
+        """
+        self.teardown_hooks.append(hook)
+        self.handlers = None
+        return hook
+
+    def freeze(self):
+        """
+        Assembles the request hooks and view functions into one handler per
+        route. Called automatically on the first request after routes or hooks
+        have been changed.
+        """
+        handlers = []
+        for pattern, callback in self.routes:
+            before, after, teardown = self.route_hooks.get((pattern, callback),
+                                                           ((), (), ()))
+            handlers.append((pattern, self.make_handler(
+                callback,
+                tuple(self.before_hooks) + before,
+                after + tuple(reversed(self.after_hooks)),
+                teardown + tuple(reversed(self.teardown_hooks)),
+                tuple(reversed(self.after_hooks))
+            )))
+        if self.before_hooks or self.after_hooks or self.teardown_hooks:
+            self.not_found_handler = self.make_handler(
+                not_found, tuple(self.before_hooks), (),
+                tuple(reversed(self.teardown_hooks)),
+                tuple(reversed(self.after_hooks)))
+        else:
+            self.not_found_handler = None
+        self.handlers = handlers
+        return handlers
+
+    def make_handler(self, callback, before, after, teardown, error_after=()):
+        # `error_after` are the after hooks that should get error responses.
+        if not (before or after or teardown or error_after):
+            return callback
+        def run_teardown(environ, exc):
+            for hook in teardown:
+                try:
+                    hook(environ, exc)
+                except Exception:
+                    traceback.print_exc()
+        def handler(environ, **kwargs):
+            error = None
+            try:
+                try:
+                    for hook in before:
+                        retval = hook(environ)
+                        if retval is not None:
+                            break
+                    else:
+                        retval = callback(environ, **kwargs)
+                    if after:
+                        if isinstance(retval, tuple) and len(retval) == 3:
+                            status, headers, body = retval
+                            headers = dict(headers)
+                        else:
+                            status, headers, body = 200, {}, retval
+                        for hook in after:
+                            status, headers, body = hook(environ, status, headers, body)
+                        retval = status, headers, body
+                except Exception, error:
+                    if not error_after:
+                        raise
+                    status, headers, body = self.error_response(sys.exc_info())
+                    for hook in error_after:
+                        status, headers, body = hook(environ, status, headers, body)
+                    retval = status, headers, body
+            except Exception, exc:
+                exc_info = sys.exc_info()
+                run_teardown(environ, exc)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if error is not None:
+                # Error responses are never streamed.
+                run_teardown(environ, error)
+                return retval
+            if not teardown:
+                return retval
+            is_triple = isinstance(retval, tuple) and len(retval) == 3
+            body = retval[2] if is_triple else retval
+            # Files are kept as they are so that they can be passed to the
+            # server's file wrapper; they don't need the view's resources.
+            if body is None or isinstance(body, (list, tuple, bytes, unicode, file)):
+                run_teardown(environ, None)
+                return retval
+            body = _ClosingIterator(body, functools.partial(run_teardown, environ))
+            return retval[:2] + (body,) if is_triple else body
+        return handler
+
     def build_url(self, callback_name, **wildcards):
         """
         The routing counterpart: Returns a URL matching a pattern using the
@@ -175,30 +367,24 @@ class NanoApplication(object):
             return getattr(local, 'SCRIPT_NAME', '') + url
 
     def __call__(self, environ, start_response):
-        callback, kwargs = self.dispatch(environ)
+        handlers = self.handlers
+        if handlers is None:
+            handlers = self.freeze()
+        callback, kwargs = self.dispatch(environ, handlers)
 
         if callback is None:
             # No route matched the requested URL. HTTP 404.
-            start_response(format_status(404), [('Content-Length', '0')])
-            return []
+            if self.not_found_handler is None:
+                start_response(format_status(404), [('Content-Length', '0')])
+                return []
+            callback, kwargs = self.not_found_handler, {}
 
         local.SCRIPT_NAME = environ.get('SCRIPT_NAME', '')
 
         try:
-            try:
-                retval = callback(environ, **kwargs)
-            except Exception, e:
-                if isinstance(e, HttpError):
-                    raise
-                raise HttpError, HttpError(500, exc_info=sys.exc_info())
-        except HttpError, http_err:
-            status = http_err.status
-            headers = {}
-            is_traceback, body = http_err.get_body(self.debug)
-            if is_traceback:
-                headers['Content-Type'] = 'text/plain'
-            if status == 500:
-                traceback.print_exception(*http_err.get_exc_info())
+            retval = callback(environ, **kwargs)
+        except Exception:
+            status, headers, body = self.error_response(sys.exc_info())
         else:
             if isinstance(retval, tuple) and len(retval) == 3:
                 status, headers, body = retval
@@ -208,8 +394,12 @@ class NanoApplication(object):
 
         if not body and isinstance(body, (list, tuple, bytes, unicode)):
             # Empty body, return early.
-            headers['Content-Length'] = '0'
-            start_response(format_status(status), headers.items())
+            status = format_status(status)
+            if status[:3] not in ('204', '304'):
+                # 204 and 304 responses must not claim a length of 0 (a 304's
+                # Content-Length would be that of the unconditional response).
+                headers['Content-Length'] = '0'
+            start_response(status, headers.items())
             return []
 
         if isinstance(body, (list, tuple)):
@@ -235,9 +425,24 @@ class NanoApplication(object):
         start_response(format_status(status), headers.items())
         return body
 
-    def dispatch(self, environ):
+    def error_response(self, exc_info):
+        # Makes a `(status, headers, body)` triple for the exception described
+        # by `exc_info`, which is either a `HttpError` or turned into a 500.
+        http_err = exc_info[1]
+        if not isinstance(http_err, HttpError):
+            http_err = HttpError(500, exc_info=exc_info)
+        status = http_err.status
+        headers = {}
+        is_traceback, body = http_err.get_body(self.debug)
+        if is_traceback:
+            headers['Content-Type'] = 'text/plain'
+        if status == 500:
+            traceback.print_exception(*http_err.get_exc_info())
+        return status, headers, body
+
+    def dispatch(self, environ, routes=None):
         request_path = environ['PATH_INFO'] or '/'
-        for route, callback in self.routes:
+        for route, callback in self.routes if routes is None else routes:
             match = route.match(request_path)
             if match is not None:
                 return callback, match.groupdict()
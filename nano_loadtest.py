@@ -0,0 +1,294 @@
+"""
+Load testing for Nano applications
+
+:Copyright: 2010-2011, Jonas Haag <jonas@lophus.org>
+:License: 2-clause BSD
+"""
+import sys
+import time
+import math
+import urllib
+import httplib
+import functools
+import threading
+import SocketServer
+import multiprocessing
+from StringIO import StringIO
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from nano import format_status
+
+def make_environ(path='/', method='GET', body='', headers=None):
+    """
+    Returns a minimal WSGI `environ` dictionary for a request to `path`,
+    suitable for calling a :class:`nano.NanoApplication` without any server.
+
+    `path` may contain a query string. `headers` is a mapping of HTTP header
+    names to values, e.g. ``{'Content-Type': 'application/json'}``.
+    """
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in (headers or {}).items():
+        name = name.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = value
+    return environ
+
+def _percentile(sorted_values, percent):
+    # Nearest-rank percentile.
+    if not sorted_values:
+        return None
+    index = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, index)]
+
+class LoadTestReport(object):
+    """
+    Result of a :func:`loadtest` run.
+
+    Attributes:
+        `elapsed`
+            Wall clock time the run took, in seconds
+        `peak_memory`
+            Peak resident set size in KiB after the run or `None` if
+            unavailable. With worker threads, this is the high-water mark of
+            the current process over its whole lifetime, so it may stem from
+            before the run; with worker processes, it is the largest
+            high-water mark among the workers.
+        `peak_memory_before`
+            High-water mark of the current process in KiB before the run
+        `routes`
+            Maps route patterns to statistics dictionaries with the keys
+            `requests`, `errors` (responses with status >= 500), `throughput`
+            (requests per second) and `p50`, `p95`, `p99`, `max` (latencies in
+            seconds, `None` if there were no requests). Requests no route
+            matched are listed as ``'<404>'``.
+        `total`
+            Statistics over all requests, same keys as above
+    """
+    def __init__(self, samples, elapsed, peak_memory=None,
+                       peak_memory_before=None):
+        self.elapsed = elapsed
+        self.peak_memory = peak_memory
+        self.peak_memory_before = peak_memory_before
+        by_route = {}
+        for route, status, latency in samples:
+            by_route.setdefault(route, []).append((status, latency))
+        self.routes = dict((route, self._stats(route_samples))
+                           for route, route_samples in by_route.items())
+        self.total = self._stats([sample[1:] for sample in samples])
+
+    def _stats(self, samples):
+        latencies = sorted(latency for _, latency in samples)
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for status, _ in samples
+                          if int(status.split(None, 1)[0]) >= 500),
+            'throughput': len(samples) / self.elapsed if self.elapsed else 0.0,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        }
+
+    def __str__(self):
+        width = max([len(name) for name in self.routes] + [24])
+        row = '%-' + str(width) + 's %8s %7s %10s %9s %9s %9s'
+        lines = [row % ('route', 'requests', 'errors', 'req/s',
+                        'p50 ms', 'p95 ms', 'p99 ms')]
+        ms = lambda latency: '-' if latency is None else '%.3f' % (latency * 1000)
+        for name, stats in sorted(self.routes.items()) + [('TOTAL', self.total)]:
+            lines.append(row % (
+                name, stats['requests'], stats['errors'],
+                '%.1f' % stats['throughput'],
+                ms(stats['p50']), ms(stats['p95']), ms(stats['p99'])
+            ))
+        if self.peak_memory is not None:
+            lines.append('peak memory: %d KiB (before run: %d KiB)'
+                         % (self.peak_memory, self.peak_memory_before))
+        return '\n'.join(lines)
+
+def _call_inprocess(app, request):
+    method, path, body, headers = request
+    environ = make_environ(path, method, body, headers)
+    status = []
+    def start_response(status_, headers_, exc_info=None):
+        status.append(status_)
+    start = time.time()
+    try:
+        retval = app(environ, start_response)
+        try:
+            for chunk in retval:
+                pass
+        finally:
+            if hasattr(retval, 'close'):
+                retval.close()
+    except Exception:
+        status.append(format_status(500))
+    return status[-1], time.time() - start
+
+def _call_socket(address, request):
+    method, path, body, headers = request
+    connection = httplib.HTTPConnection(*address)
+    start = time.time()
+    try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        response.read()
+        status = '%d %s' % (response.status, response.reason)
+    except Exception:
+        status = format_status(500)
+    connection.close()
+    return status, time.time() - start
+
+# Set before forking worker processes so that unpicklable applications
+# (routes to lambdas, closures, ...) can be used with ``processes=True``.
+_loadtest_call = None
+
+def _run_jobs(jobs, call):
+    return [(route,) + call(request) for route, request in jobs]
+
+def _run_jobs_in_process(jobs):
+    return _run_jobs(jobs, _loadtest_call), _get_maxrss()
+
+def _get_maxrss():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on OS X, kilobytes elsewhere
+        maxrss //= 1024
+    return maxrss
+
+class _ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def _get_route(app, environ):
+    # Like `NanoApplication.dispatch`, but returns the matching pattern.
+    request_path = environ['PATH_INFO'] or '/'
+    for pattern, callback in app.routes:
+        if pattern.match(request_path) is not None:
+            return pattern.pattern[1:-1]
+    return '<404>'
+
+def loadtest(app, requests, concurrency=1, iterations=1, processes=False,
+             server=False):
+    """
+    Replays a request mix against `app` from `concurrency` threads (or
+    processes) and returns a :class:`LoadTestReport` with throughput and
+    latency percentiles per route.
+
+    By default, requests are made in-process, without any network involved.
+    Response bodies are always consumed completely, so file serving and
+    streaming views are measured, too.
+
+    Parameters:
+        `requests`
+            Sequence of requests, each either a path string (a `GET` request)
+            or a tuple ``(method, path[, body[, headers]])``.
+        `concurrency`
+            Number of workers issuing requests in parallel
+        `iterations`
+            How often `requests` should be replayed. Requests are distributed
+            round-robin among the workers.
+        `processes`
+            Use worker processes instead of threads (requires `fork`)
+        `server`
+            Serve `app` from a local threaded socket server (:mod:`wsgiref`)
+            and send the requests over HTTP
+
+    ::
+
+        report = loadtest(app, ['/', '/post/hello/', ('POST', '/comment/', 'hi')],
+                          concurrency=8, iterations=1000)
+        print report
+    """
+    global _loadtest_call
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1 (got %r)" % concurrency)
+    jobs = []
+    for request in requests:
+        if isinstance(request, basestring):
+            request = ('GET', request)
+        elif not isinstance(request, (tuple, list)) or not 2 <= len(request) <= 4:
+            raise ValueError("Requests must be paths or (method, path[, body"
+                             "[, headers]]) tuples (got %r)" % (request,))
+        # Fill in default body and headers.
+        request = tuple(request) + ('', None)[len(request)-2:]
+        jobs.append((_get_route(app, make_environ(request[1])), request))
+    jobs *= iterations
+    slices = [jobs[i::concurrency] for i in xrange(concurrency)]
+
+    httpd = None
+    if server:
+        httpd = make_server('127.0.0.1', 0, app,
+                            server_class=_ThreadingWSGIServer,
+                            handler_class=_QuietWSGIRequestHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        call = functools.partial(_call_socket, httpd.server_address)
+    else:
+        call = functools.partial(_call_inprocess, app)
+
+    peak_memory_before = _get_maxrss()
+    try:
+        if processes:
+            _loadtest_call = call
+            pool = multiprocessing.Pool(concurrency)
+            try:
+                start = time.time()
+                results = pool.map(_run_jobs_in_process, slices)
+                elapsed = time.time() - start
+            finally:
+                pool.terminate()
+                _loadtest_call = None
+            samples = sum((result[0] for result in results), [])
+            peak_memory = max(result[1] for result in results)
+        else:
+            go = threading.Event()
+            results = [[] for _ in slices]
+            def worker(jobs, result):
+                go.wait()
+                result.extend(_run_jobs(jobs, call))
+            threads = [threading.Thread(target=worker, args=args)
+                       for args in zip(slices, results)]
+            for thread in threads:
+                thread.start()
+            start = time.time()
+            go.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            samples = sum(results, [])
+            peak_memory = _get_maxrss()
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+
+    return LoadTestReport(samples, elapsed, peak_memory, peak_memory_before)
@@ -0,0 +1,232 @@
+"""
+Server-Sent Events for Nano applications
+
+:Copyright: 2010-2011, Jonas Haag <jonas@lophus.org>
+:License: 2-clause BSD
+"""
+import threading
+import collections
+
+class _Channel(object):
+    def __init__(self, name, buffersize):
+        self.name = name
+        self.buffer = collections.deque(maxlen=buffersize)
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.subscriptions = set()
+        self.pollers = 0
+        # Set once the channel has been removed from the hub; protected by
+        # `condition` so that nobody publishes to or joins a removed channel.
+        self.removed = False
+
+    def get_next_id(self, last_id):
+        # Returns the id of the first event to send to a client that has seen
+        # the event `last_id` (a string or `None`).
+        try:
+            last_id = int(last_id)
+        except (TypeError, ValueError):
+            return self.next_id
+        first_id = self.next_id - len(self.buffer)
+        if last_id >= self.next_id:
+            # Unknown id, e.g. from before a server restart: Replay the buffer.
+            return first_id
+        return max(last_id + 1, first_id)
+
+class Subscription(object):
+    """
+    Iterator over the events published to a :class:`BroadcastHub` channel,
+    returned from :meth:`BroadcastHub.subscribe`. Usable as response body.
+    """
+    def __init__(self, hub, channel, next_id):
+        self.hub = hub
+        self.channel = channel
+        self.next_id = next_id
+        self.closed = False
+        self.started = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.started:
+            # Yield something right away so that the server sends the headers.
+            self.started = True
+            return self.hub.heartbeat_event
+        channel = self.channel
+        with channel.condition:
+            while self.next_id >= channel.next_id and not self.closed:
+                channel.condition.wait(self.hub.heartbeat)
+                if self.hub.heartbeat is not None:
+                    break
+            if self.closed:
+                raise StopIteration
+            if self.next_id >= channel.next_id:
+                # Heartbeat timeout
+                return self.hub.heartbeat_event
+            first_id = channel.next_id - len(channel.buffer)
+            if self.next_id < first_id:
+                # Client is too slow, events it did not read yet are gone.
+                if self.hub.policy == 'disconnect':
+                    self._close()
+                    raise StopIteration
+                self.next_id = first_id
+            event = channel.buffer[self.next_id - first_id]
+            self.next_id += 1
+            return event
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.hub.leave(self.channel, self)
+            self.channel.condition.notify_all()
+
+    def close(self):
+        """Ends the stream; called by the WSGI server once the client is gone."""
+        with self.channel.condition:
+            self._close()
+
+class BroadcastHub(object):
+    """
+    Fans out Server-Sent Events to any number of subscribers.
+
+    Every event is encoded only once into a per-channel ring buffer of the
+    `buffersize` most recent events; subscribers merely keep a cursor into
+    that buffer. A subscriber that falls behind by more than `buffersize`
+    events is handled according to `policy`: ``'drop'`` skips the events it
+    missed, ``'disconnect'`` ends its stream (browsers will reconnect with a
+    `Last-Event-ID` header). If `heartbeat` is set, an SSE comment is sent to
+    idle subscribers every `heartbeat` seconds to keep connections alive.
+
+    Events are numbered per channel; the number is sent as event `id`.
+    Channels are created on demand and removed again once nobody is
+    subscribed to them and nothing has been published to them. ::
+
+        hub = nano_sse.BroadcastHub(heartbeat=15)
+
+        @app.route('/live/:channel:/')
+        def live(environ, channel):
+            return hub.response(channel, environ.get('HTTP_LAST_EVENT_ID'))
+
+        hub.publish('news', 'Hello World', event='greeting')
+    """
+    def __init__(self, buffersize=100, policy='drop', heartbeat=None,
+                       charset='utf-8'):
+        if policy not in ('drop', 'disconnect'):
+            raise ValueError("policy must be 'drop' or 'disconnect' "
+                             "(got %r instead)" % policy)
+        self.channels = {}
+        self.buffersize = buffersize
+        self.policy = policy
+        self.heartbeat = heartbeat
+        self.heartbeat_event = ':\n\n'
+        self.charset = charset
+        self.lock = threading.Lock()
+
+    def get_channel(self, name):
+        with self.lock:
+            if name not in self.channels:
+                self.channels[name] = _Channel(name, self.buffersize)
+            return self.channels[name]
+
+    # Locking order: A channel's `condition` is always acquired before the
+    # hub's `lock`.
+
+    def join(self, name, make_subscription=None):
+        # Registers a subscription created by `make_subscription(channel)` (or,
+        # if `None`, a poller) with the channel so that the channel is kept
+        # until `leave` is called. Returns the channel and the subscription.
+        while True:
+            channel = self.get_channel(name)
+            with channel.condition:
+                if channel.removed:
+                    continue
+                if make_subscription is None:
+                    channel.pollers += 1
+                    return channel, None
+                subscription = make_subscription(channel)
+                channel.subscriptions.add(subscription)
+                return channel, subscription
+
+    def leave(self, channel, subscription=None):
+        with channel.condition:
+            if subscription is None:
+                channel.pollers -= 1
+            else:
+                channel.subscriptions.discard(subscription)
+            if not (channel.subscriptions or channel.pollers or channel.buffer):
+                channel.removed = True
+                with self.lock:
+                    if self.channels.get(channel.name) is channel:
+                        del self.channels[channel.name]
+
+    def publish(self, channel, data, event=None):
+        """
+        Sends `data` (a string; may contain newlines) to all subscribers of
+        `channel` and returns the event's id.
+        """
+        name = channel
+        if isinstance(data, unicode):
+            data = data.encode(self.charset)
+        if isinstance(event, unicode):
+            event = event.encode(self.charset)
+        lines = ['data: ' + line for line in data.split('\n')]
+        if event is not None:
+            lines.insert(0, 'event: ' + event)
+        lines = '\n'.join(lines) + '\n\n'
+        while True:
+            channel = self.get_channel(name)
+            with channel.condition:
+                if channel.removed:
+                    continue
+                event_id = channel.next_id
+                channel.buffer.append('id: %d\n%s' % (event_id, lines))
+                channel.next_id += 1
+                channel.condition.notify_all()
+                return event_id
+
+    def subscribe(self, channel, last_id=None):
+        """
+        Returns a :class:`Subscription` iterating over the encoded events
+        published to `channel` from now on or, if `last_id` is given, all
+        events following the event with that id (as far as still buffered).
+        Unknown ids (e.g. from before a server restart) replay all buffered
+        events; invalid ones are ignored.
+        """
+        channel, subscription = self.join(channel, lambda channel:
+            Subscription(self, channel, channel.get_next_id(last_id)))
+        return subscription
+
+    def response(self, channel, last_id=None):
+        """
+        Returns an ``(status, headers, body)`` tuple streaming `channel` to
+        the client, ready to be returned from a view.
+        """
+        return 200, {'Content-Type': 'text/event-stream',
+                     'Cache-Control': 'no-cache'}, \
+               self.subscribe(channel, last_id)
+
+    def poll(self, channel, last_id=None, timeout=None):
+        """
+        Long-polling counterpart to :meth:`subscribe`: Waits up to `timeout`
+        seconds for events following `last_id` (interpreted as described
+        there) and returns them (joined into one string, possibly empty) along
+        with the id of the last event.
+        """
+        channel, _ = self.join(channel)
+        try:
+            with channel.condition:
+                next_id = channel.get_next_id(last_id)
+                if next_id >= channel.next_id:
+                    channel.condition.wait(timeout)
+                first_id = channel.next_id - len(channel.buffer)
+                events = list(channel.buffer)[max(next_id - first_id, 0):]
+                return ''.join(events), channel.next_id - 1
+        finally:
+            self.leave(channel)
+
+    def close(self):
+        """Ends all subscribers' streams."""
+        for channel in self.channels.values():
+            with channel.condition:
+                for subscription in list(channel.subscriptions):
+                    subscription._close()
@@ -0,0 +1,209 @@
+"""
+Static assets for Nano applications
+
+:Copyright: 2010-2011, Jonas Haag <jonas@lophus.org>
+:License: 2-clause BSD
+"""
+import os
+import time
+import gzip
+import hashlib
+import mimetypes
+import threading
+from StringIO import StringIO
+from wsgiref.handlers import format_date_time
+
+from nano import HttpError
+
+def accepts_encoding(accept_encoding, coding):
+    # Evaluates an `Accept-Encoding` header, including q-values.
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[params[0].strip().lower()] = q
+    return qvalues.get(coding, qvalues.get('*', 0)) > 0
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison as required for `If-None-Match`.
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+class _Asset(object):
+    def __init__(self, assets, name, path, stat):
+        self.name = name
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        checksum = hashlib.md5()
+        with open(path, 'rb') as fd:
+            if self.size <= assets.max_size:
+                # Small file, keep it in memory.
+                self.content = fd.read()
+                checksum.update(self.content)
+            else:
+                self.content = None
+                for chunk in iter(lambda: fd.read(assets.app.chunksize), ''):
+                    checksum.update(chunk)
+        digest = checksum.hexdigest()[:12]
+        base, ext = os.path.splitext(name)
+        self.hashed_name = '%s.%s%s' % (base, digest, ext)
+
+        mime, _ = mimetypes.guess_type(name)
+        self.headers = {
+            'Content-Type': mime or 'application/octet-stream',
+            'Cache-Control': 'public, max-age=%d, immutable' % assets.max_age,
+            'Expires': format_date_time(time.time() + assets.max_age),
+            'ETag': '"%s"' % digest,
+        }
+        self.gzipped = None
+        if self.content and assets.is_compressible(self.headers['Content-Type']):
+            buf = StringIO()
+            gzip_file = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+            gzip_file.write(self.content)
+            gzip_file.close()
+            if buf.tell() < self.size:
+                self.gzipped = buf.getvalue()
+                self.headers['Vary'] = 'Accept-Encoding'
+                self.gzip_headers = dict(self.headers)
+                self.gzip_headers['Content-Encoding'] = 'gzip'
+                self.gzip_headers['ETag'] = '"%s-gz"' % digest
+
+class StaticAssets(object):
+    """
+    Serves the files in `directory` under URLs containing a hash of their
+    contents, so that browsers can cache them forever (``Cache-Control:
+    immutable``) and never have to revalidate them.
+
+    Files are fingerprinted on startup. Files no larger than `max_size` bytes
+    are kept in memory, along with a gzip-compressed variant for text-like
+    files; larger ones are streamed from disk. If `check_interval` is not
+    `None`, file modification times are checked at most every
+    `check_interval` seconds (when serving or building URLs) and changed,
+    added or removed files are picked up.
+
+    The view serving the files is routed at `prefix` (which must not contain
+    regular expression syntax) and named `name`, so it must be unique among
+    all route targets. Use :meth:`url` to get the URL of a file::
+
+        assets = nano_static.StaticAssets(app, 'static/')
+
+        @app.route('/')
+        def index(environ):
+            return '<link rel=stylesheet href="%s">' % assets.url('css/site.css')
+    """
+    compressible_types = ('application/javascript', 'application/json',
+                          'application/xml', 'image/svg+xml')
+    not_modified_headers = ('ETag', 'Cache-Control', 'Expires', 'Vary')
+
+    def __init__(self, app, directory, prefix='/static/', name='static',
+                       max_size=256*1024, max_age=365*24*60*60,
+                       check_interval=2):
+        self.app = app
+        self.directory = directory
+        self.name = name
+        self.max_size = max_size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.assets = {}
+        self.hashed_assets = {}
+        self.lock = threading.Lock()
+        self.rescan()
+
+        def view(environ, path):
+            return self.serve(environ, path)
+        view.__name__ = name
+        app.route(prefix + '(?P<path>.+)')(view)
+
+    def is_compressible(self, content_type):
+        return content_type.startswith('text/') or \
+               content_type in self.compressible_types
+
+    def rescan(self):
+        """
+        Fingerprints all new and modified files in the asset directory.
+        Files that can't be read are skipped.
+        """
+        self.last_check = time.time()
+        assets = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, '/')
+                asset = self.assets.get(name)
+                try:
+                    stat = os.stat(path)
+                    if asset is None or asset.mtime != stat.st_mtime \
+                                     or asset.size != stat.st_size:
+                        asset = _Asset(self, name, path, stat)
+                except (OSError, IOError):
+                    # Dangling symlink, or the file is being replaced right
+                    # now (e.g. by an editor's atomic save): Keep the previous
+                    # version, if any, and retry on the next rescan.
+                    if asset is None:
+                        continue
+                assets[name] = asset
+        self.assets = assets
+        self.hashed_assets = dict((asset.hashed_name, asset)
+                                  for asset in assets.itervalues())
+
+    def check(self):
+        if self.check_interval is None or \
+           time.time() - self.last_check < self.check_interval:
+            return
+        if self.lock.acquire(False):
+            # Other threads continue to use the old assets while rescanning.
+            try:
+                self.rescan()
+            finally:
+                self.lock.release()
+
+    def url(self, name):
+        """
+        Returns the URL of the current version of file `name` (relative to
+        the asset directory) using :meth:`nano.NanoApplication.build_url`.
+
+        :raises KeyError: If there's no such file
+        """
+        self.check()
+        return self.app.build_url(self.name, path=self.assets[name].hashed_name)
+
+    def serve(self, environ, path):
+        self.check()
+        asset = self.hashed_assets.get(path)
+        if asset is None:
+            raise HttpError(404)
+        if asset.gzipped is not None and \
+           accepts_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), 'gzip'):
+            headers, content = asset.gzip_headers, asset.gzipped
+        else:
+            headers, content = asset.headers, asset.content
+        if etag_matches(environ.get('HTTP_IF_NONE_MATCH', ''), headers['ETag']):
+            return 304, dict((name, value) for name, value in headers.items()
+                             if name in self.not_modified_headers), ''
+        if content is not None:
+            return 200, headers, content
+        try:
+            fd = open(asset.path, 'rb')
+        except IOError:
+            raise HttpError(404)
+        stat = os.fstat(fd.fileno())
+        if stat.st_mtime != asset.mtime or stat.st_size != asset.size:
+            # Changed since it was fingerprinted, so these aren't the contents
+            # the hashed URL stands for. Rescan on the next occasion.
+            fd.close()
+            self.last_check = 0
+            raise HttpError(404)
+        return 200, headers, fd
@@ -1,13 +1,19 @@
 # coding: utf-8
+import os
 try:
     from unittest2 import TestCase, main
 except ImportError:
     from unittest import TestCase, main
 
-from nano import NanoApplication, HttpError
+from nano import local, NanoApplication, HttpError
+from nano_static import StaticAssets
+from nano_sse import BroadcastHub
+from nano_loadtest import make_environ, loadtest
 
 class Test(TestCase):
     def setUp(self):
+        # Forget SCRIPT_NAME set by requests in previous tests
+        vars(local).clear()
         self.app = NanoApplication()
         self.setup()
 
@@ -170,6 +176,16 @@ class TestReturnTypes(Test):
             'headers' : {'Content-Length' : '42', 'Content-Type' : 'text/plain'},
             'status' : '123 <reason>'
         },
+        (304, {'ETag' : '"x"'}, ''), {
+            'body' : [],
+            'headers' : {'ETag' : '"x"'},
+            'status' : '304 Not Modified'
+        },
+        ('204 No Content', {}, []), {
+            'body' : [],
+            'headers' : {},
+            'status' : '204 No Content'
+        },
         ('200 ok', {'Content-Type' : 'foo/bar'}, []), {
             'body' : [],
             'headers' : {'Content-Length' : '0', 'Content-Type' : 'foo/bar'}
@@ -221,5 +237,427 @@ class TestReturnTypes(Test):
         finally:
             from os import remove; remove(fname)
 
+class TestHooks(Test):
+    def setup(self):
+        self.calls = calls = []
+        def view(env):
+            calls.append('view')
+            return iter(['foo'])
+        def route_before(env):
+            calls.append('route before')
+        def route_after(env, status, headers, body):
+            calls.append('route after')
+            headers['X-Route'] = '1'
+            return status, headers, body
+        @self.app.before_request
+        def before(env):
+            calls.append('before')
+            if env['PATH_INFO'] == '/denied':
+                raise HttpError(403)
+            if env['PATH_INFO'] == '/cached':
+                return 'cached'
+        @self.app.after_request
+        def after(env, status, headers, body):
+            calls.append('after')
+            headers['X-Global'] = '1'
+            return '201 Created' if status == 200 else status, headers, body
+        @self.app.teardown_request
+        def teardown(env, exc):
+            calls.append(('teardown', type(exc).__name__))
+        self.view = view
+        self.app.route('/(denied|cached)?', before=[route_before],
+                       after=[route_after])(view)
+
+    def test_order(self):
+        response = self.call_app('/')
+        self.assertEqual(self.calls, ['before', 'route before', 'view',
+                                      'route after', 'after'])
+        self.assertEqual(response.status, '201 Created')
+        self.assertEqual(response.headers, {'X-Route': '1', 'X-Global': '1'})
+        # Streamed bodies are not read by the hooks; teardown hooks are run
+        # once the server closes the body.
+        self.assertEqual(list(response.body), ['foo'])
+        self.assertEqual(self.calls[-1], 'after')
+        response.body.close()
+        response.body.close()
+        self.assertEqual(self.calls[-1], ('teardown', 'NoneType'))
+        self.assertEqual(self.calls.count(('teardown', 'NoneType')), 1)
+
+    def test_streamed_body(self):
+        def view(env):
+            yield 'foo'
+            self.calls.append('body streamed')
+            raise TypeError
+        self.app.route('/stream')(view)
+        response = self.call_app('/stream')
+        self.assertEqual(response.body.next(), 'foo')
+        self.assertRaises(TypeError, list, response.body)
+        response.body.close()
+        self.assertEqual(self.calls[-2:], ['body streamed',
+                                           ('teardown', 'TypeError')])
+
+    def test_failing_teardown(self):
+        @self.app.teardown_request
+        def teardown(env, exc):
+            raise ValueError
+        import nano
+        print_exc = nano.traceback.print_exc
+        nano.traceback.print_exc = lambda: self.calls.append('printed')
+        try:
+            self.assertResponse('/denied', status='403 Forbidden')
+            self.assertResponse('/cached', status='201 Created')
+        finally:
+            nano.traceback.print_exc = print_exc
+        self.assertEqual(self.calls.count('printed'), 2)
+        self.assertEqual(self.calls.count(('teardown', 'HttpError')), 1)
+
+    def test_short_circuit(self):
+        self.assertResponse('/cached', status='201 Created', body=['cached'])
+        self.assertNotIn('view', self.calls)
+        self.assertResponse('/denied', status='403 Forbidden', body=[])
+        self.assertEqual(self.calls[-1], ('teardown', 'HttpError'))
+
+    def test_error_responses(self):
+        # Global after hooks see error responses, route-specific ones don't
+        self.assertResponse('/denied', status='403 Forbidden', body=[],
+                            headers={'X-Global': '1', 'Content-Length': '0'})
+        self.assertEqual(self.calls, ['before', 'after',
+                                      ('teardown', 'HttpError')])
+        del self.calls[:]
+        import nano
+        print_exception = nano.traceback.print_exception
+        nano.traceback.print_exception = lambda *args: None
+        try:
+            self.app.route('/fail', after=[lambda *args: self.fail()])(
+                lambda env: 1 / 0)
+            self.assertResponse('/fail', status='500 Internal Server Error',
+                                headers={'X-Global': '1', 'Content-Length': '0'})
+        finally:
+            nano.traceback.print_exception = print_exception
+        self.assertEqual(self.calls, ['before', 'after',
+                                      ('teardown', 'ZeroDivisionError')])
+
+    def test_not_found(self):
+        self.assertResponse('/nope', status='404 Not Found', body=[],
+                            headers={'X-Global': '1', 'Content-Length': '0'})
+        self.assertEqual(self.calls, ['before', 'after',
+                                      ('teardown', 'HttpError')])
+
+    def test_no_hooks(self):
+        app = NanoApplication()
+        app.route('/')(self.view)
+        self.assertEqual(app.freeze(), app.routes)
+        self.assertEqual(app.dispatch({'PATH_INFO': '/'}, app.handlers),
+                         (self.view, {}))
+
+    def test_refreeze(self):
+        self.call_app('/')
+        self.app.route('/other')(self.view)
+        self.app.teardown_request(lambda env, exc: self.calls.append('late'))
+        del self.calls[:]
+        self.call_app('/other').body.close()
+        # Later global after/teardown hooks wrap earlier ones
+        self.assertEqual(self.calls, ['before', 'view', 'after', 'late',
+                                      ('teardown', 'NoneType')])
+
+class TestStaticAssets(Test):
+    def setup(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'css'))
+        self.write('css/site.css', 'body { color: #42 }' * 10)
+        self.write('big.txt', 'x' * 1000)
+        self.assets = StaticAssets(self.app, self.dir, max_size=500,
+                                   check_interval=None)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as fd:
+            fd.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_url(self):
+        self.assertRegexpMatches(self.assets.url('css/site.css'),
+                                 '^/static/css/site\.[0-9a-f]{12}\.css$')
+        self.assertEqual(self.app.build_url('static', path='foo'), '/static/foo')
+        self.assertRaises(KeyError, self.assets.url, 'nope.css')
+
+    def test_serve(self):
+        url = self.assets.url('css/site.css')
+        response = self.call_app(url)
+        self.assertEqual(response.body, ['body { color: #42 }' * 10])
+        self.assertEqual(response.headers['Content-Type'], 'text/css')
+        self.assertEqual(response.headers['Content-Length'], '190')
+        self.assertEqual(response.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertContains(response.headers, 'Expires', 'ETag', 'Vary')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.call_app(url, {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        import gzip, StringIO
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO.StringIO(response.body[0])).read(),
+            'body { color: #42 }' * 10)
+
+        gzip_etag = response.headers['ETag']
+        etag = self.call_app(url).headers['ETag']
+        self.assertEqual(gzip_etag, etag[:-1] + '-gz"')
+        for accept_encoding in ['gzip;q=0, identity', 'deflate', '*, gzip;q=0']:
+            self.assertNotIn('Content-Encoding', self.call_app(
+                url, {'HTTP_ACCEPT_ENCODING': accept_encoding}).headers)
+        self.assertIn('Content-Encoding', self.call_app(
+            url, {'HTTP_ACCEPT_ENCODING': 'identity, *;q=0.5'}).headers)
+
+        response = self.call_app(url, {'HTTP_IF_NONE_MATCH': 'W/"x", ' + etag})
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertEqual(response.body, [])
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertContains(response.headers, 'Cache-Control', 'Expires', 'Vary')
+        self.assertNotIn('Content-Type', response.headers)
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertResponse(url, {'HTTP_IF_NONE_MATCH': gzip_etag},
+                            status='200 OK')
+        self.assertResponse(url, {'HTTP_IF_NONE_MATCH': gzip_etag,
+                                  'HTTP_ACCEPT_ENCODING': 'gzip'},
+                            status='304 Not Modified')
+        self.assertResponse('/static/css/site.css', status='404 Not Found')
+
+        # Too big to be kept in memory
+        response = self.call_app(self.assets.url('big.txt'))
+        self.assertEqual(''.join(response.body), 'x' * 1000)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_rescan(self):
+        old_url = self.assets.url('css/site.css')
+        self.write('css/site.css', 'body {}', mtime=42)
+        self.write('new.css', 'a {}')
+        os.remove(os.path.join(self.dir, 'big.txt'))
+        self.assertEqual(self.assets.url('css/site.css'), old_url)
+
+        self.assets.check_interval = 0
+        new_url = self.assets.url('css/site.css')
+        self.assertNotEqual(new_url, old_url)
+        self.assertResponse(old_url, status='404 Not Found')
+        self.assertResponse(new_url, body=['body {}'])
+        self.assertResponse(self.assets.url('new.css'), body=['a {}'])
+        self.assertRaises(KeyError, self.assets.url, 'big.txt')
+
+    def test_unreadable_files(self):
+        url = self.assets.url('css/site.css')
+        os.symlink(os.path.join(self.dir, 'nope'),
+                   os.path.join(self.dir, 'css', '.#site.css'))
+        self.assets.check_interval = 0
+        self.assertResponse(url, status='200 OK')
+        self.assertEqual(self.assets.url('css/site.css'), url)
+        self.assertRaises(KeyError, self.assets.url, 'css/.#site.css')
+
+        # Files vanishing between listing and reading keep their old version
+        import nano_static
+        _Asset = nano_static._Asset
+        def vanished(*args):
+            raise IOError(2, 'No such file or directory')
+        nano_static._Asset = vanished
+        try:
+            self.write('css/site.css', 'body {}', mtime=42)
+            self.assertEqual(self.assets.url('css/site.css'), url)
+        finally:
+            nano_static._Asset = _Asset
+        self.assertNotEqual(self.assets.url('css/site.css'), url)
+
+    def test_big_file_changed(self):
+        url = self.assets.url('big.txt')
+        # Changed or removed files must not be served under the old hash
+        self.write('big.txt', 'y' * 1000, mtime=42)
+        self.assertResponse(url, status='404 Not Found')
+        os.remove(os.path.join(self.dir, 'big.txt'))
+        self.assertResponse(url, status='404 Not Found')
+
+class TestBroadcastHub(Test):
+    def setup(self):
+        self.hub = BroadcastHub(buffersize=3)
+
+    def subscribe(self, *args):
+        subscription = self.hub.subscribe('c', *args)
+        self.assertEqual(subscription.next(), ':\n\n')
+        return subscription
+
+    def test_publish(self):
+        sub1, sub2 = self.subscribe(), self.subscribe()
+        self.assertEqual(self.hub.publish('c', u'foo\nbär', event='x'), 1)
+        self.hub.publish('c', 'bar')
+        self.hub.publish('other', 'baz')
+        event = sub1.next()
+        self.assertEqual(event, 'id: 1\nevent: x\ndata: foo\ndata: b\xc3\xa4r\n\n')
+        # Encoded only once
+        self.assert_(sub2.next() is event)
+        self.assertEqual(sub1.next(), 'id: 2\ndata: bar\n\n')
+        self.assertEqual(self.subscribe(1).next(), 'id: 2\ndata: bar\n\n')
+
+    def test_slow_subscriber(self):
+        sub = self.subscribe()
+        for i in xrange(5):
+            self.hub.publish('c', str(i))
+        self.assertEqual([sub.next(), sub.next(), sub.next()],
+                         ['id: 3\ndata: 2\n\n', 'id: 4\ndata: 3\n\n',
+                          'id: 5\ndata: 4\n\n'])
+
+        self.hub = BroadcastHub(buffersize=3, policy='disconnect')
+        sub = self.subscribe()
+        for i in xrange(5):
+            self.hub.publish('c', str(i))
+        self.assertRaises(StopIteration, sub.next)
+        self.assertEqual(self.hub.get_channel('c').subscriptions, set())
+        self.assertRaises(ValueError, BroadcastHub, policy='foo')
+
+    def test_heartbeat_and_close(self):
+        self.hub.heartbeat = 0.01
+        sub = self.subscribe()
+        self.assertEqual(sub.next(), ':\n\n')
+        self.hub.close()
+        self.assertRaises(StopIteration, sub.next)
+
+    def test_poll(self):
+        self.assertEqual(self.hub.poll('c', timeout=0.01), ('', 0))
+        for i in xrange(2):
+            self.hub.publish('c', str(i))
+        self.assertEqual(self.hub.poll('c', 0),
+                         ('id: 1\ndata: 0\n\nid: 2\ndata: 1\n\n', 2))
+        self.assertEqual(self.hub.poll('c', 2, timeout=0.01), ('', 2))
+
+    def test_last_id(self):
+        self.hub.publish('c', 'foo')
+        # Unknown ids, e.g. from before a server restart, replay the buffer
+        for last_id in ['500', 500]:
+            self.assertEqual(self.subscribe(last_id).next(), 'id: 1\ndata: foo\n\n')
+            self.assertEqual(self.hub.poll('c', last_id),
+                             ('id: 1\ndata: foo\n\n', 1))
+        # Invalid ids are ignored
+        sub = self.subscribe('foo')
+        self.hub.publish('c', 'bar')
+        self.assertEqual(sub.next(), 'id: 2\ndata: bar\n\n')
+        self.assertEqual(self.hub.poll('c', 'foo', timeout=0.01), ('', 2))
+        # Ids of events no longer buffered start at the oldest buffered event
+        for i in xrange(3):
+            self.hub.publish('c', str(i))
+        self.assertEqual(self.subscribe(-1).next(), 'id: 3\ndata: 0\n\n')
+
+    def test_channel_cleanup(self):
+        sub = self.subscribe()
+        self.hub.poll('other', timeout=0.01)
+        self.assertEqual(self.hub.channels.keys(), ['c'])
+        sub.close()
+        sub.close()
+        self.assertEqual(self.hub.channels, {})
+        # Channels that have been published to are kept
+        self.hub.publish('c', 'foo')
+        self.subscribe().close()
+        self.assertEqual(self.hub.channels.keys(), ['c'])
+
+    def test_removed_channel(self):
+        # A channel removed by its last subscriber leaving while a publisher
+        # or a new subscriber got hold of it must not be used anymore.
+        stale = self.hub.get_channel('c')
+        self.subscribe().close()
+        self.assert_(stale.removed)
+        get_channel = self.hub.get_channel
+        stale_first = [stale]
+        self.hub.get_channel = lambda name: \
+            stale_first.pop() if stale_first else get_channel(name)
+        self.assertEqual(self.hub.publish('c', 'foo'), 1)
+        self.assert_(self.hub.channels['c'] is not stale)
+        self.assertEqual(list(stale.buffer), [])
+
+        stale_first.append(stale)
+        sub = self.subscribe(0)
+        self.assert_(sub.channel is self.hub.channels['c'])
+        self.assertEqual(sub.next(), 'id: 1\ndata: foo\n\n')
+
+    def test_response(self):
+        self.route(lambda env: self.hub.response('c', env.get('HTTP_LAST_EVENT_ID')))
+        self.hub.publish('c', 'foo')
+        response = self.call_app(environ={'HTTP_LAST_EVENT_ID': '0'})
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers, {'Content-Type': 'text/event-stream',
+                                            'Cache-Control': 'no-cache'})
+        self.assertEqual([response.body.next(), response.body.next()],
+                         [':\n\n', 'id: 1\ndata: foo\n\n'])
+        response.body.close()
+        self.assertRaises(StopIteration, response.body.next)
+
+class TestLoadTest(Test):
+    def setup(self):
+        def index(env): return 'Hello World'
+        def echo(env): return env['wsgi.input'].read(int(env['CONTENT_LENGTH']))
+        def fail(env): raise HttpError(503)
+        self.app.route('/')(index)
+        self.app.route('/echo/')(echo)
+        self.app.route('/fail/')(fail)
+        self.requests = ['/', ('POST', '/echo/', 'foo', {'X-Foo': 'bar'}),
+                         '/fail/', '/nope/']
+
+    def test_make_environ(self):
+        environ = make_environ('/a%20b/?x=1', 'POST', 'body',
+                               {'Content-Type': 'text/plain', 'X-Foo': 'bar'})
+        self.assertEqual(environ['PATH_INFO'], '/a b/')
+        self.assertEqual(environ['QUERY_STRING'], 'x=1')
+        self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+        self.assertEqual(environ['CONTENT_LENGTH'], '4')
+        self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(environ['HTTP_X_FOO'], 'bar')
+        self.assertEqual(environ['wsgi.input'].read(), 'body')
+
+    def assertReport(self, report, iterations):
+        self.assertEqual(sorted(report.routes), ['/', '/echo/', '/fail/', '<404>'])
+        self.assertEqual(report.total['requests'], 4 * iterations)
+        self.assertEqual(report.total['errors'], iterations)
+        self.assertEqual(report.routes['/fail/']['errors'], iterations)
+        for stats in report.routes.values():
+            self.assertEqual(stats['requests'], iterations)
+            self.assert_(0 <= stats['p50'] <= stats['p95'] <= stats['p99'] <= stats['max'])
+            self.assert_(stats['throughput'] > 0)
+        self.assertIn('TOTAL', str(report))
+        self.assert_(report.peak_memory > 0 and report.peak_memory_before > 0)
+
+    def test_empty(self):
+        report = loadtest(self.app, [])
+        self.assertEqual(report.routes, {})
+        self.assertEqual(report.total['requests'], 0)
+        self.assertEqual(report.total['p99'], None)
+        self.assertIn('TOTAL', str(report))
+        self.assertRaises(ValueError, loadtest, self.app, ['/'], concurrency=0)
+        for request in [('GET',), ('GET', '/', '', {}, 'x'), 42]:
+            self.assertRaises(ValueError, loadtest, self.app, [request])
+
+    def test_routes(self):
+        # Routes are told apart even if their targets share a name
+        view = lambda env: 'foo'
+        self.app.route('/a/:x:/')(view)
+        self.app.route('/b')(lambda env: 'bar')
+        self.app.route('/c')(view)
+        report = loadtest(self.app, ['/a/1/', '/a/2/', ['GET', '/b'], '/c'])
+        self.assertEqual(dict((name, stats['requests'])
+                              for name, stats in report.routes.items()),
+                         {'/a/(?P<x>[^/]+)/': 2, '/b': 1, '/c': 1})
+        self.assertIn('/a/(?P<x>[^/]+)/', str(report))
+
+    def test_threads(self):
+        self.assertReport(loadtest(self.app, self.requests, concurrency=4,
+                                   iterations=25), 25)
+
+    def test_processes(self):
+        self.assertReport(loadtest(self.app, self.requests, concurrency=2,
+                                   iterations=5, processes=True), 5)
+
+    def test_server(self):
+        self.assertReport(loadtest(self.app, self.requests, concurrency=2,
+                                   iterations=5, server=True), 5)
+
 if __name__ == '__main__':
     main()